@@ -1,37 +1,61 @@
 import os
 from pathlib import Path
+from typing import Optional
 
 from .config import ConfigManager
-from .translator import SubtitleTranslator
+from .translator import SubtitleTranslator, INITIAL_BATCH_SIZE, MAX_BATCH_SIZE
 
 
 class SubtitleTranslatorApp:
-    def __init__(self, config_path: str = "config.yaml", verbose: bool = False):
+    def __init__(self, config_path: str = "config.yaml", verbose: bool = False, use_cache: bool = True):
         self.verbose = verbose
         self.config_manager = ConfigManager(config_path)
         self.config = self.config_manager.load_config()
+        if not use_cache:
+            self.config.cache.enabled = False
         self.api_key = self.config_manager.get_openai_api_key()
         
         self.translator = SubtitleTranslator(self.config, self.api_key)
     
     def translate_file(self, input_path: str, output_path: str, source_lang: str, target_lang: str, 
-                      batch_size: int = 10):
+                      batch_size: Optional[int] = None, max_concurrency: Optional[int] = None, mode: str = "sync"):
         output_path_obj = Path(output_path)
         output_path_obj.parent.mkdir(parents=True, exist_ok=True)
         
         if self.verbose:
             print(f"Translating from {source_lang} to {target_lang}")
             print("Using simple approach: extract text -> translate -> preserve structure")
-            print(f"Batch size: {batch_size} entries per API call")
-            print(f"Output will be saved incrementally to: {output_path}")
-            print(f"Checkpoint file: {output_path}.checkpoint")
+            if mode == "batch":
+                if batch_size:
+                    print(f"Batch size: up to {batch_size} entries per API call")
+                else:
+                    print("Batch size: as many entries per API call as the token budget allows")
+            else:
+                maximum = min(batch_size, MAX_BATCH_SIZE) if batch_size else MAX_BATCH_SIZE
+                print(f"Batch size: adapts from {min(INITIAL_BATCH_SIZE, maximum)} up to {maximum} entries per API call")
+            if mode == "batch":
+                print("Mode: OpenAI Batch API (results may take up to 24h)")
+                print(f"Output will be saved to: {output_path}")
+                print(f"Batch job file: {output_path}.batchjob")
+            else:
+                print(f"Max concurrency: {max_concurrency or self.config.max_concurrency} batches in parallel")
+                print(f"Output will be saved incrementally to: {output_path}")
+                print(f"Checkpoint file: {output_path}.checkpoint")
             print("-" * 60)
         
         try:
-            translated_entries = self.translator.translate_file(
-                input_path, output_path, source_lang, target_lang, 
-                batch_size=batch_size, verbose=self.verbose
-            )
+            if mode == "batch":
+                from .translator_batchapi import BatchAPITranslator
+                batch_translator = BatchAPITranslator(self.translator, self.api_key)
+                translated_entries = batch_translator.translate_file(
+                    input_path, output_path, source_lang, target_lang,
+                    batch_size=batch_size, verbose=self.verbose
+                )
+            else:
+                translated_entries = self.translator.translate_file(
+                    input_path, output_path, source_lang, target_lang, 
+                    batch_size=batch_size, verbose=self.verbose, max_concurrency=max_concurrency
+                )
             
             if self.verbose:
                 print("-" * 60)
@@ -42,7 +66,10 @@ class SubtitleTranslatorApp:
         except Exception as e:
             print(f"❌ Error during translation: {str(e)}")
             if self.verbose:
-                print("💡 You can restart the command to resume from the last checkpoint")
+                if mode == "batch":
+                    print("💡 You can restart the command to keep waiting for the submitted batch job")
+                else:
+                    print("💡 You can restart the command to resume from the last checkpoint")
                 import traceback
                 traceback.print_exc()
             raise
\ No newline at end of file
@@ -0,0 +1,70 @@
+import os
+import queue
+import threading
+from typing import Callable, Optional
+
+from .srt_parser import SubtitleTable, WRITE_BUFFER_SIZE
+
+
+# fdatasync skips the metadata flush fsync does; Windows and macOS only have fsync
+_datasync = getattr(os, 'fdatasync', os.fsync)
+
+# Queue item telling the writer thread to stop once everything before it is written
+_STOP = object()
+
+
+class CheckpointWriter(threading.Thread):
+    """
+    Daemon thread owning the checkpoint and output SRT handles, so the translation
+    loop hands finished batches over and never waits on disk writes or syncs
+    """
+
+    def __init__(self, checkpoint_file: str, output_file: str,
+                 write_output: Callable, write_checkpoint: Callable):
+        super().__init__(name="checkpoint-writer", daemon=True)
+        self.checkpoint_file = checkpoint_file
+        self.output_file = output_file
+        self.write_output = write_output
+        self.write_checkpoint = write_checkpoint
+        self.error: Optional[BaseException] = None
+        self._queue = queue.Queue()
+
+    def enqueue(self, batch_translated: SubtitleTable):
+        """Hand a contiguous run of translated entries to the writer without blocking"""
+        if self.error is not None:
+            raise self.error
+        self._queue.put(batch_translated)
+
+    def flush_and_close(self):
+        """Write everything still queued, close both files and re-raise any write error"""
+        if self.is_alive():
+            self._queue.put(_STOP)
+            self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        try:
+            with open(self.checkpoint_file, 'ab') as checkpoint, \
+                    open(self.output_file, 'ab', buffering=WRITE_BUFFER_SIZE) as output:
+                stop = False
+                while not stop:
+                    item = self._queue.get()
+
+                    # Write whatever else piled up meanwhile before paying for one sync
+                    while True:
+                        if item is _STOP:
+                            stop = True
+                            break
+                        self.write_output(output, item)
+                        self.write_checkpoint(checkpoint, item)
+                        try:
+                            item = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+
+                    output.flush()
+                    checkpoint.flush()
+                    _datasync(checkpoint.fileno())
+        except BaseException as e:
+            self.error = e
@@ -9,8 +9,15 @@ from pathlib import Path
 @click.option('--target-lang', '-t', required=True, help='Target language (e.g., French, German)')
 @click.option('--config', '-c', default='config.yaml', help='Path to config file')
 @click.option('--verbose', '-v', is_flag=True, help='Enable verbose output')
-@click.option('--batch-size', default=10, help='Number of subtitle entries per batch')
-def translate_subtitles(input_file, output_file, source_lang, target_lang, config, verbose, batch_size):
+@click.option('--batch-size', type=int, default=None,
+              help='Maximum subtitles per batch (default: 64; the actual size adapts automatically)')
+@click.option('--max-concurrency', type=int, default=None,
+              help='Number of batches translated in parallel (default: from config)')
+@click.option('--mode', type=click.Choice(['sync', 'batch']), default='sync',
+              help='sync: translate now; batch: use the OpenAI Batch API (half price, up to 24h)')
+@click.option('--no-cache', is_flag=True, help='Ignore and do not update the translation caches')
+def translate_subtitles(input_file, output_file, source_lang, target_lang, config, verbose, batch_size,
+                        max_concurrency, mode, no_cache):
     """
     Translate SRT subtitle files using OpenAI models via LangChain.
     
@@ -18,7 +25,7 @@ def translate_subtitles(input_file, output_file, source_lang, target_lang, confi
     OUTPUT_FILE: Path to the output translated SRT file
     """
     from .app import SubtitleTranslatorApp
-    app = SubtitleTranslatorApp(config_path=config, verbose=verbose)
+    app = SubtitleTranslatorApp(config_path=config, verbose=verbose, use_cache=not no_cache)
     
     try:
         app.translate_file(
@@ -26,7 +33,9 @@ def translate_subtitles(input_file, output_file, source_lang, target_lang, confi
             output_path=str(output_file),
             source_lang=source_lang,
             target_lang=target_lang,
-            batch_size=batch_size
+            batch_size=batch_size,
+            max_concurrency=max_concurrency,
+            mode=mode
         )
         
         if not verbose:  # Only show this if not in verbose mode (verbose mode has its own completion message)
@@ -1,16 +1,28 @@
 import yaml
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Optional
 from dotenv import load_dotenv
 
 
+# libyaml's C loader when PyYAML was built with it, several times faster than the pure-Python one
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Wire formats for sending subtitle batches: compact 'id<TAB>text' lines, or JSON with structured outputs
+PROTOCOLS = ("delimited", "json")
+
+
 @dataclass
 class OpenAIConfig:
     model: str
     max_tokens: int
     temperature: float
     context_buffer: int
+    requests_per_minute: int = 500
+    tokens_per_minute: int = 200000
+    protocol: str = "delimited"
+    request_timeout: float = 120
 
 
 @dataclass
@@ -19,10 +31,20 @@ class ChunkingConfig:
     overlap_lines: int
 
 
+@dataclass
+class CacheConfig:
+    enabled: bool = True
+    path: str = ".translation_cache.db"
+    response_path: str = ".llm_cache"
+    ttl: Optional[int] = 7 * 24 * 3600
+
+
 @dataclass
 class AppConfig:
     openai: OpenAIConfig
     chunking: ChunkingConfig
+    cache: CacheConfig = field(default_factory=CacheConfig)
+    max_concurrency: int = 4
 
 
 class ConfigManager:
@@ -41,23 +63,41 @@ class ConfigManager:
             raise FileNotFoundError(f"Config file not found: {self.config_path}")
         
         with open(self.config_path, 'r') as file:
-            data = yaml.safe_load(file)
+            data = yaml.load(file, Loader=YAML_LOADER)
         
         openai_config = OpenAIConfig(
             model=data['openai']['model'],
             max_tokens=data['openai']['max_tokens'],
             temperature=data['openai']['temperature'],
-            context_buffer=data['openai']['context_buffer']
+            context_buffer=data['openai']['context_buffer'],
+            requests_per_minute=data['openai'].get('requests_per_minute', 500),
+            tokens_per_minute=data['openai'].get('tokens_per_minute', 200000),
+            protocol=data['openai'].get('protocol', "delimited"),
+            request_timeout=data['openai'].get('request_timeout', 120)
         )
         
+        if openai_config.protocol not in PROTOCOLS:
+            raise ValueError(f"openai.protocol must be one of {', '.join(PROTOCOLS)}, "
+                             f"got '{openai_config.protocol}'")
+        
         chunking_config = ChunkingConfig(
             max_chunk_size=data['chunking']['max_chunk_size'],
             overlap_lines=data['chunking']['overlap_lines']
         )
         
+        cache_data = data.get('cache', {})
+        cache_config = CacheConfig(
+            enabled=cache_data.get('enabled', True),
+            path=cache_data.get('path', ".translation_cache.db"),
+            response_path=cache_data.get('response_path', ".llm_cache"),
+            ttl=cache_data.get('ttl', 7 * 24 * 3600)
+        )
+        
         return AppConfig(
             openai=openai_config,
-            chunking=chunking_config
+            chunking=chunking_config,
+            cache=cache_config,
+            max_concurrency=data.get('max_concurrency', 4)
         )
     
     def get_openai_api_key(self) -> str:
@@ -0,0 +1,41 @@
+from typing import List
+from pydantic import BaseModel
+
+
+class Translated(BaseModel):
+    id: int
+    text: str
+
+
+class BatchOut(BaseModel):
+    # Structured outputs require an object at the root, so the array is wrapped
+    translations: List[Translated]
+
+
+# Strict JSON schema for OpenAI structured outputs, matching BatchOut
+BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "subtitle_translations",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "translations": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer"},
+                            "text": {"type": "string"}
+                        },
+                        "required": ["id", "text"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["translations"],
+            "additionalProperties": False
+        }
+    }
+}
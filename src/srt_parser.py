@@ -1,10 +1,18 @@
+import mmap
+import os
 import re
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
 from pathlib import Path
 
 
-@dataclass
+# Large buffer and chunked joins keep SRT output to a few big writes
+WRITE_BUFFER_SIZE = 1 << 20
+WRITE_CHUNK_ENTRIES = 1000
+
+
+# Slotted and immutable: no per-instance __dict__, and rows are never edited in place
+@dataclass(slots=True, frozen=True)
 class SubtitleEntry:
     index: int
     start_time: str
@@ -15,55 +23,96 @@ class SubtitleEntry:
         return f"{self.index}\n{self.start_time} --> {self.end_time}\n{self.text}\n"
 
 
+@dataclass
+class SubtitleTable:
+    """
+    Subtitles stored column-wise; SubtitleEntry objects are only built when writing SRT
+    """
+    index: List[int] = field(default_factory=list)
+    start: List[str] = field(default_factory=list)
+    end: List[str] = field(default_factory=list)
+    text: List[str] = field(default_factory=list)
+    
+    def __len__(self) -> int:
+        return len(self.index)
+    
+    def append(self, index: int, start: str, end: str, text: str):
+        self.index.append(index)
+        self.start.append(start)
+        self.end.append(end)
+        self.text.append(text)
+    
+    def extend(self, other: 'SubtitleTable'):
+        self.index.extend(other.index)
+        self.start.extend(other.start)
+        self.end.extend(other.end)
+        self.text.extend(other.text)
+    
+    def slice(self, i: int, j: int, text: Optional[List[str]] = None) -> 'SubtitleTable':
+        """Rows i:j, optionally with their text column replaced (e.g. by translations)"""
+        return SubtitleTable(
+            index=self.index[i:j],
+            start=self.start[i:j],
+            end=self.end[i:j],
+            text=self.text[i:j] if text is None else text
+        )
+    
+    def entries(self) -> Iterator[SubtitleEntry]:
+        for index, start, end, text in zip(self.index, self.start, self.end, self.text):
+            yield SubtitleEntry(index=index, start_time=start, end_time=end, text=text)
+
+
 class SRTParser:
     def __init__(self):
-        self.time_pattern = re.compile(r'(\d{2}:\d{2}:\d{2},\d{3}) --> (\d{2}:\d{2}:\d{2},\d{3})')
+        # One block per match: index line, timing line, then text up to the next blank line.
+        # The text group is optional so a block without text can't swallow the next one.
+        self.block_pattern = re.compile(
+            rb'^(?:\xef\xbb\xbf)?[ \t]*(\d+)[ \t]*\r?\n'
+            rb'(\d{2}:\d{2}:\d{2},\d{3}) --> (\d{2}:\d{2}:\d{2},\d{3})[^\r\n]*'
+            rb'(?:\r?\n(?![ \t]*\r?\n)(.*?))?'
+            rb'(?=\r?\n[ \t]*\r?\n|\s*\Z)',
+            re.MULTILINE | re.DOTALL
+        )
     
-    def parse(self, file_path: str) -> List[SubtitleEntry]:
+    def parse(self, file_path: str) -> SubtitleTable:
         path = Path(file_path)
         if not path.exists():
             raise FileNotFoundError(f"SRT file not found: {file_path}")
         
-        with open(path, 'r', encoding='utf-8') as file:
-            content = file.read().strip()
-        
-        return self._parse_content(content)
+        with open(path, 'rb') as file:
+            # mmap can't map an empty file
+            if os.fstat(file.fileno()).st_size == 0:
+                return SubtitleTable()
+            
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                return self._parse_content(content)
     
-    def _parse_content(self, content: str) -> List[SubtitleEntry]:
-        entries = []
-        blocks = content.split('\n\n')
-        
-        for block in blocks:
-            if not block.strip():
-                continue
-                
-            lines = block.strip().split('\n')
-            if len(lines) < 3:
+    def _parse_content(self, content) -> SubtitleTable:
+        """Build the subtitle columns from raw SRT bytes in a single scan"""
+        table = SubtitleTable()
+        for match in self.block_pattern.finditer(content):
+            index, start_time, end_time, text = match.groups()
+            if text is None:
                 continue
             
-            try:
-                index = int(lines[0])
-                time_match = self.time_pattern.match(lines[1])
-                
-                if not time_match:
-                    continue
-                
-                start_time, end_time = time_match.groups()
-                text = '\n'.join(lines[2:])
-                
-                entries.append(SubtitleEntry(
-                    index=index,
-                    start_time=start_time,
-                    end_time=end_time,
-                    text=text
-                ))
-                
-            except (ValueError, IndexError):
-                continue
+            table.append(
+                int(index),
+                start_time.decode('ascii'),
+                end_time.decode('ascii'),
+                text.decode('utf-8').replace('\r\n', '\n')
+            )
         
-        return entries
+        return table
+    
+    def write_srt(self, table: SubtitleTable, output_path: str):
+        with open(output_path, 'wb', buffering=WRITE_BUFFER_SIZE) as file:
+            self.write_entries(file, table)
     
-    def write_srt(self, entries: List[SubtitleEntry], output_path: str):
-        with open(output_path, 'w', encoding='utf-8') as file:
-            for entry in entries:
-                file.write(entry.to_srt_format() + '\n')
\ No newline at end of file
+    def write_entries(self, file, table: SubtitleTable):
+        """Write subtitles to an already open binary file, e.g. one opened for appending"""
+        for i in range(0, len(table), WRITE_CHUNK_ENTRIES):
+            chunk = table.slice(i, i + WRITE_CHUNK_ENTRIES)
+            file.write(b''.join(
+                entry.to_srt_format().encode('utf-8') + b'\n'
+                for entry in chunk.entries()
+            ))
@@ -1,30 +1,204 @@
-import json
+import asyncio
+import hashlib
 import os
-from typing import List, Optional
+import re
+import sys
+import time
+from functools import lru_cache
+from typing import List, Optional, Tuple
 from pathlib import Path
-from langchain_openai import ChatOpenAI
-from langchain.schema import HumanMessage, SystemMessage
+import orjson
 
-from .srt_parser import SubtitleEntry, SRTParser
+from .srt_parser import SubtitleTable, SRTParser
 from .config import AppConfig
+from .translator_cache import TranslationCache
+from .checkpoint_writer import CheckpointWriter
+
+# langchain, openai, tiktoken, tenacity and pydantic are imported where first used,
+# they dominate startup time and aren't needed until a translation actually runs
+
+
+# Bump whenever the prompts change so cached translations from older prompts are not reused.
+# Each protocol has its own prompt, so the protocol is part of the cache key as well
+PROMPT_VERSION = 6
+
+# Share of the reply budget (max_tokens - context_buffer) filled with payload when packing
+# batches; the rest absorbs translations that come out longer than their source
+PACKING_BUDGET_RATIO = 0.8
+
+# Entries per request the adaptive sizer starts at and never grows beyond
+INITIAL_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 64
+
+# Tokens spent on the per-entry wrapper: '{"id": N, "text": ...}' for json, 'N<TAB>' for delimited
+ENTRY_OVERHEAD_TOKENS = {"json": 12, "delimited": 3}
+
+
+# Speaker tags, sound cues and formatting tags: [MAN], (laughs), <i>, {\an8}
+MARKER_RE = re.compile(r'(\[[^\]]+\]|\([^)]+\)|<[^>]+>|\{[^}]+\})')
+
+# Markers (and surrounding whitespace) at either end of a subtitle, around the text to translate
+EDGE_MARKERS_PATTERN = re.compile(
+    rf'(?P<prefix>(?:\s*{MARKER_RE.pattern})*\s*)(?P<core>.*?)(?P<suffix>(?:\s*{MARKER_RE.pattern})*\s*)',
+    re.DOTALL
+)
+
+# An HTML-style formatting tag, capturing the closing slash and the tag name
+FORMATTING_TAG_PATTERN = re.compile(r'<(/?)([A-Za-z][^\s/>]*)[^>]*>')
+
+# An escape in a delimited reply: '\\' for a backslash, '\n' for a line break
+DELIMITED_ESCAPE_PATTERN = re.compile(r'\\([\\n])')
+
+# A complete '"id": N, "text": "..."' pair in a JSON reply, allowing escaped quotes in the text
+ENTRY_PATTERN = re.compile(r'"id"\s*:\s*(\d+)\s*,\s*"text"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+class RateLimiter:
+    """
+    Token bucket for OpenAI requests-per-minute and tokens-per-minute limits,
+    modeled on the OpenAI cookbook's api_request_parallel_processor
+    """
+    
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.rpm_capacity = float(requests_per_minute)
+        self.tpm_capacity = float(tokens_per_minute)
+        self._last_update = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        self._last_update = now
+        self.rpm_capacity = min(self.requests_per_minute,
+                                self.rpm_capacity + self.requests_per_minute * elapsed / 60)
+        self.tpm_capacity = min(self.tokens_per_minute,
+                                self.tpm_capacity + self.tokens_per_minute * elapsed / 60)
+    
+    async def acquire(self, tokens: int = 0):
+        """Wait until both buckets have capacity for one request of the given size"""
+        # A request larger than the whole bucket would never fit, let it through once full
+        tokens = min(tokens, self.tokens_per_minute)
+        
+        # Holding the lock while sleeping keeps waiters in FIFO order
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.rpm_capacity >= 1 and self.tpm_capacity >= tokens:
+                    self.rpm_capacity -= 1
+                    self.tpm_capacity -= tokens
+                    return
+                
+                wait = max(
+                    (1 - self.rpm_capacity) * 60 / self.requests_per_minute,
+                    (tokens - self.tpm_capacity) * 60 / self.tokens_per_minute
+                )
+                await asyncio.sleep(wait)
+
+
+class AdaptiveBatchSizer:
+    """
+    AIMD control of entries per request: grow by 25% after each clean batch,
+    halve after a truncated/incomplete reply or a timeout
+    """
+    
+    def __init__(self, initial: int = INITIAL_BATCH_SIZE, maximum: int = MAX_BATCH_SIZE):
+        self.maximum = maximum
+        self.size = float(min(initial, maximum))
+    
+    @property
+    def current(self) -> int:
+        return max(1, int(self.size))
+    
+    def on_success(self):
+        self.size = min(self.size * 1.25, self.maximum)
+    
+    def on_failure(self):
+        self.size = max(self.size // 2, 1)
+
+
+class ApproximateEncoding:
+    """
+    Stand-in for a tiktoken encoding: one token per 3 UTF-8 bytes, on the high side for
+    Latin scripts (about 4 characters per token) and close for CJK (about 1 per character)
+    """
+    
+    def encode(self, text: str) -> range:
+        return range(len(text.encode('utf-8')) // 3 + 1)
 
 
 class SubtitleTranslator:
     def __init__(self, config: AppConfig, api_key: str):
+        from langchain_openai import ChatOpenAI
+        from openai import InternalServerError
+        
         self.config = config
         self.llm = ChatOpenAI(
             model=config.openai.model,
             temperature=config.openai.temperature,
             max_tokens=config.openai.max_tokens,
-            openai_api_key=api_key
+            openai_api_key=api_key,
+            timeout=config.openai.request_timeout,
+            # The OpenAI client would otherwise retry 429s, 5xx and timeouts itself, behind the
+            # rate limiter's back and before timeouts can shrink the batch; the layers below do it
+            max_retries=0,
+            model_kwargs=self._response_format_kwargs(config.openai.protocol)
+        )
+        # Transient server errors are retried by LangChain; 429s and dropped connections go back
+        # through the rate limiter in _invoke, and timeouts are split into smaller requests instead
+        self.retrying_llm = self.llm.with_retry(
+            retry_if_exception_type=(InternalServerError,),
+            wait_exponential_jitter=True,
+            stop_after_attempt=3
         )
         self.parser = SRTParser()
+        self.rate_limiter = None
+        self.batch_sizer = None
+        self.cache = None
+        self.response_cache = None
+        if config.cache.enabled:
+            import diskcache
+            self.cache = TranslationCache(config.cache.path)
+            self.response_cache = diskcache.Cache(config.cache.response_path)
+        
+        self._token_counts = {}
+        self._enc = self._load_encoding(config.openai.model)
+    
+    @staticmethod
+    def _load_encoding(model: str):
+        """The model's tiktoken encoding, or a length-based estimate when none can be loaded"""
+        # The Windows exe ships the encoding files, tiktoken would otherwise download them
+        bundle_dir = getattr(sys, '_MEIPASS', None)
+        if bundle_dir and 'TIKTOKEN_CACHE_DIR' not in os.environ:
+            os.environ['TIKTOKEN_CACHE_DIR'] = os.path.join(bundle_dir, 'tiktoken_cache')
+        
+        try:
+            import tiktoken
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:  # model unknown to tiktoken
+                return tiktoken.get_encoding("o200k_base")
+        
+        except Exception as e:
+            # Unregistered encoding, or its file could not be downloaded
+            print(f"Warning: Could not load a tokenizer, estimating token counts instead: {e}")
+            return ApproximateEncoding()
     
     def translate_file(self, input_file: str, output_file: str, source_lang: str, target_lang: str, 
-                      batch_size: int = 10, verbose: bool = False):
+                      batch_size: Optional[int] = None, verbose: bool = False,
+                      max_concurrency: Optional[int] = None):
         """
         Simple approach with checkpointing: Extract text, translate in batches, map back to original structure
         """
+        if max_concurrency is None:
+            max_concurrency = self.config.max_concurrency
+        return asyncio.run(self._translate_file_async(
+            input_file, output_file, source_lang, target_lang, batch_size, verbose, max_concurrency
+        ))
+    
+    async def _translate_file_async(self, input_file: str, output_file: str, source_lang: str, target_lang: str,
+                                    batch_size: Optional[int], verbose: bool, max_concurrency: int):
         # Parse original SRT file
         entries = self.parser.parse(input_file)
         if verbose:
@@ -32,60 +206,87 @@ class SubtitleTranslator:
         
         # Check for existing checkpoint
         checkpoint_file = f"{output_file}.checkpoint"
-        translated_entries = self._load_checkpoint(checkpoint_file, entries)
+        translated = self._load_checkpoint(checkpoint_file, entries)
         
-        start_index = len(translated_entries)
+        start_index = len(translated)
         if start_index > 0 and verbose:
             print(f"Resuming from checkpoint: {start_index}/{len(entries)} entries already translated")
         
-        # Translate remaining entries in batches
-        for i in range(start_index, len(entries), batch_size):
-            batch_end = min(i + batch_size, len(entries))
-            batch_entries = entries[i:batch_end]
-            
-            if verbose:
-                print(f"Translating batch {i//batch_size + 1}: entries {i+1}-{batch_end}/{len(entries)}")
-            
-            try:
-                # Extract texts from this batch
-                batch_texts = [entry.text for entry in batch_entries]
-                
-                if verbose:
-                    for j, entry in enumerate(batch_entries):
-                        print(f"  Entry {i+j+1}: '{entry.text[:50]}{'...' if len(entry.text) > 50 else ''}'")
+        # The limiter's lock belongs to this event loop, so create it per run
+        self.rate_limiter = RateLimiter(self.config.openai.requests_per_minute,
+                                        self.config.openai.tokens_per_minute)
+        
+        # Batch size adapts to how the model copes; --batch-size can only lower the hard cap
+        maximum = min(batch_size, MAX_BATCH_SIZE) if batch_size else MAX_BATCH_SIZE
+        self.batch_sizer = AdaptiveBatchSizer(initial=min(INITIAL_BATCH_SIZE, maximum), maximum=maximum)
+        
+        # Rewrite both files from the checkpoint once, dropping anything past its last
+        # complete record, so that from here on they only ever need to be appended to
+        self._save_checkpoint(checkpoint_file, translated)
+        self.parser.write_srt(translated, output_file)
+        
+        # Batches are cut only when a slot frees up, so each one uses the latest batch size.
+        # They finish out of order; buffer them by start index and flush contiguously
+        # so the checkpoint and output file always hold a prefix of the subtitles
+        running = set()
+        pending = {}
+        next_start = start_index
+        next_index = start_index
+        number = 0
+        error = None
+        
+        # Writes and syncs happen on a background thread so batches keep flowing meanwhile
+        writer = CheckpointWriter(checkpoint_file, output_file,
+                                  self.parser.write_entries, self._append_checkpoint)
+        writer.start()
+        try:
+            while running or (error is None and next_start < len(entries)):
+                # Translate remaining entries in batches, up to max_concurrency API calls in flight
+                while error is None and next_start < len(entries) and len(running) < max(1, max_concurrency):
+                    batch_end = self._next_batch_end(entries, next_start, self.batch_sizer.current)
+                    number += 1
+                    running.add(asyncio.create_task(self._translate_batch_async(
+                        entries, number, next_start, batch_end, source_lang, target_lang, verbose
+                    )))
+                    next_start = batch_end
                 
-                # Translate the entire batch in one API call
-                translated_texts = self._translate_batch_texts(batch_texts, source_lang, target_lang)
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        batch_start, batch_translated = task.result()
+                    except Exception as e:
+                        # Stop dispatching but let in-flight batches finish: they are already
+                        # paid for, and whatever they add to the contiguous prefix is kept
+                        if error is None:
+                            error = e
+                        continue
+                    pending[batch_start] = batch_translated
                 
-                # Create translated entries for this batch
-                batch_translated = []
-                for j, entry in enumerate(batch_entries):
-                    translated_text = translated_texts[j] if j < len(translated_texts) else entry.text
-                    batch_translated.append(SubtitleEntry(
-                        index=entry.index,
-                        start_time=entry.start_time,
-                        end_time=entry.end_time,
-                        text=translated_text
-                    ))
+                flushed = False
+                while next_index in pending:
+                    batch_translated = pending.pop(next_index)
+                    translated.extend(batch_translated)
+                    next_index += len(batch_translated)
                     
-                    if verbose:
-                        print(f"  ✓ Entry {i+j+1}: '{translated_text[:50]}{'...' if len(translated_text) > 50 else ''}'")
+                    # Append only the new entries to the output file and checkpoint
+                    writer.enqueue(batch_translated)
+                    flushed = True
                 
-                # Add to overall results
-                translated_entries.extend(batch_translated)
-                
-                # Save checkpoint and output file after each successful batch
-                self._save_checkpoint(checkpoint_file, translated_entries)
-                self.parser.write_srt(translated_entries, output_file)
-                
-                if verbose:
-                    print(f"✓ Batch {i//batch_size + 1} completed and saved ({len(translated_entries)}/{len(entries)} total)")
+                if flushed and verbose:
+                    print(f"✓ Saved progress ({len(translated)}/{len(entries)} total)")
                     print("")
-                    
-            except Exception as e:
-                if verbose:
-                    print(f"✗ Error translating batch {i//batch_size + 1}: {str(e)}")
-                raise
+        finally:
+            for task in running:
+                task.cancel()
+            # Whatever was translated before a failure still reaches disk
+            writer.flush_and_close()
+        
+        if error is not None:
+            raise error
+        
+        if verbose and number:
+            print(f"Sent {len(entries) - start_index} entries in {number} batches "
+                  f"(avg {(len(entries) - start_index) / number:.1f} entries/batch)")
         
         # Clean up checkpoint file on successful completion
         if os.path.exists(checkpoint_file):
@@ -93,139 +294,470 @@ class SubtitleTranslator:
             if verbose:
                 print("Translation completed successfully, checkpoint removed")
         
-        return translated_entries
+        return translated
+    
+    def translate_entries(self, entries: SubtitleTable, source_lang: str, target_lang: str) -> SubtitleTable:
+        """
+        Translate entries straight through the synchronous endpoint, without checkpointing
+        """
+        return asyncio.run(self._translate_entries_async(entries, source_lang, target_lang))
+    
+    async def _translate_entries_async(self, entries: SubtitleTable, source_lang: str,
+                                       target_lang: str) -> SubtitleTable:
+        self.rate_limiter = RateLimiter(self.config.openai.requests_per_minute,
+                                        self.config.openai.tokens_per_minute)
+        slots = asyncio.Semaphore(max(1, self.config.max_concurrency))
+        
+        async def translate(i: int, batch_end: int) -> List[str]:
+            async with slots:
+                return await self._translate_batch_texts(entries.text[i:batch_end], source_lang, target_lang)
+        
+        batch_results = await asyncio.gather(*(translate(i, batch_end) for i, batch_end in self.pack_batches(entries)))
+        return entries.slice(0, len(entries), text=[text for texts in batch_results for text in texts])
+    
+    async def _translate_batch_async(self, entries: SubtitleTable, number: int, i: int, batch_end: int,
+                                     source_lang: str, target_lang: str, verbose: bool):
+        """Translate entries[i:batch_end]"""
+        if verbose:
+            print(f"Translating batch {number}: entries {i+1}-{batch_end}/{len(entries)}")
+        
+        try:
+            # Extract texts from this batch
+            batch_texts = entries.text[i:batch_end]
+            
+            if verbose:
+                for j, text in enumerate(batch_texts):
+                    print(f"  Entry {i+j+1}: '{text[:50]}{'...' if len(text) > 50 else ''}'")
+            
+            # Translate the entire batch in one API call
+            translated_texts = await self._translate_batch_texts(batch_texts, source_lang, target_lang)
+            
+            if verbose:
+                for j, translated_text in enumerate(translated_texts):
+                    print(f"  ✓ Entry {i+j+1}: '{translated_text[:50]}{'...' if len(translated_text) > 50 else ''}'")
+                print(f"✓ Batch {number} completed")
+            
+            # Same timing columns, translated text column
+            return i, entries.slice(i, batch_end, text=translated_texts)
+                
+        except Exception as e:
+            if verbose:
+                print(f"✗ Error translating batch {number}: {str(e)}")
+            raise
+    
+    def pack_batches(self, entries: SubtitleTable, max_prompt_tokens: Optional[int] = None,
+                     start_index: int = 0, max_entries: Optional[int] = None) -> List[Tuple[int, int]]:
+        """
+        Greedily split entries[start_index:] into (start, end) ranges whose payload fits the token budget
+        """
+        batches = []
+        batch_start = start_index
+        while batch_start < len(entries):
+            batch_end = self._next_batch_end(entries, batch_start, max_entries, max_prompt_tokens)
+            batches.append((batch_start, batch_end))
+            batch_start = batch_end
+        return batches
+    
+    def _next_batch_end(self, entries: SubtitleTable, batch_start: int, max_entries: Optional[int] = None,
+                        max_prompt_tokens: Optional[int] = None) -> int:
+        """End of the batch starting at batch_start: as many entries as max_entries and the token budget allow"""
+        if max_prompt_tokens is None:
+            max_prompt_tokens = self._payload_budget()
+        
+        entry_overhead = ENTRY_OVERHEAD_TOKENS[self.config.openai.protocol]
+        batch_tokens = 0
+        for i in range(batch_start, len(entries)):
+            tokens = self._count_tokens(entries.text[i]) + entry_overhead
+            
+            batch_full = max_entries is not None and i - batch_start >= max_entries
+            if i > batch_start and (batch_full or batch_tokens + tokens > max_prompt_tokens):
+                return i
+            batch_tokens += tokens
+        
+        return len(entries)
     
-    def _translate_batch_texts(self, texts: List[str], source_lang: str, target_lang: str) -> List[str]:
+    def _reply_budget(self) -> int:
+        """Reply tokens a batch may use before it counts as close to being cut off"""
+        return self.config.openai.max_tokens - self.config.openai.context_buffer
+    
+    def _payload_budget(self) -> int:
+        """Most payload tokens one request may carry without risking a truncated reply"""
+        # The reply echoes the payload in the target language, so the reply budget
+        # bounds how much input one request can carry
+        return int(self._reply_budget() * PACKING_BUDGET_RATIO)
+    
+    def _count_tokens(self, text: str) -> int:
+        """Token count of a subtitle text, encoded once per distinct text"""
+        tokens = self._token_counts.get(text)
+        if tokens is None:
+            tokens = self._token_counts[text] = len(self._enc.encode(text))
+        return tokens
+    
+    async def _translate_batch_texts(self, texts: List[str], source_lang: str, target_lang: str) -> List[str]:
         """
-        Translate a batch of subtitle texts using JSON format for reliable parsing
+        Translate a batch of subtitle texts with id-tagged entries for reliable mapping,
+        sending only the texts that are not already in the translation cache
         """
-        # Create input JSON structure
-        input_data = []
-        for i, text in enumerate(texts):
-            input_data.append({"id": i, "text": text})
+        # Markers around the text never reach the model; they are spliced back verbatim
+        # afterwards, and lines made only of markers ([MUSIC], (laughs)) are not sent at all
+        prefixes, cores, suffixes = self._split_markers(texts)
+        
+        keys = [self._cache_key(core, source_lang, target_lang) for core in cores]
+        cached = self.cache.get_many(keys) if self.cache else {}
+        translated_cores = [cached.get(key, core) for key, core in zip(keys, cores)]
+        
+        misses = [i for i, key in enumerate(keys) if cores[i] and key not in cached]
+        if misses:
+            # Lines repeated within the batch ("Yes.", "What?") are sent once
+            unique_texts = list(dict.fromkeys(cores[i] for i in misses))
+            
+            # Errors that survive the retries propagate and stop the run at the last checkpoint,
+            # so a resume translates this batch rather than keeping untranslated originals
+            unique_translations = await self._request_translations(unique_texts, source_lang, target_lang)
+            
+            translation_by_text = dict(zip(unique_texts, unique_translations))
+            new_entries = {}
+            skipped = 0
+            for i in misses:
+                translated_text = translation_by_text[cores[i]]
+                if translated_text is None:
+                    skipped += 1  # keep the original
+                else:
+                    new_entries[keys[i]] = translated_text
+                    translated_cores[i] = translated_text
+            
+            if skipped:
+                print(f"Warning: Model skipped {skipped} of {len(texts)} entries even after a re-ask, "
+                      f"keeping their original text")
+            
+            if self.cache and new_entries:
+                self.cache.set_many(new_entries)
+        
+        return self._splice_markers(prefixes, translated_cores, suffixes)
+    
+    @staticmethod
+    def _split_markers(texts: List[str]) -> Tuple[List[str], List[str], List[str]]:
+        """Split each text into (leading markers, text to translate, trailing markers) columns"""
+        prefixes, cores, suffixes = [], [], []
+        for text in texts:
+            prefix, core, suffix = EDGE_MARKERS_PATTERN.fullmatch(text).group('prefix', 'core', 'suffix')
+            
+            # A tag pair may only move out of band as a whole ('<i>Who?</i>'); when the edges
+            # split a pair ('- Hi.\n- <i>Who?</i>', '<i>Hello</i>\n<i>World</i>'), every
+            # formatting tag stays inline so the model never sees half of one
+            if core and not (SubtitleTranslator._tags_balanced(prefix + suffix)
+                             and SubtitleTranslator._tags_balanced(core)):
+                first_tag = FORMATTING_TAG_PATTERN.search(prefix)
+                cut = first_tag.start() if first_tag else len(prefix)
+                last_tag_end = max((tag.end() for tag in FORMATTING_TAG_PATTERN.finditer(suffix)), default=0)
+                prefix, core, suffix = prefix[:cut], prefix[cut:] + core + suffix[:last_tag_end], suffix[last_tag_end:]
+            
+            prefixes.append(prefix)
+            cores.append(core)
+            suffixes.append(suffix)
+        return prefixes, cores, suffixes
+    
+    @staticmethod
+    def _tags_balanced(text: str) -> bool:
+        """Whether every formatting tag opened in text is closed in it, innermost first"""
+        open_tags = []
+        for closing, name in FORMATTING_TAG_PATTERN.findall(text):
+            if not closing:
+                open_tags.append(name.lower())
+            elif not open_tags or open_tags.pop() != name.lower():
+                return False
+        return not open_tags
+    
+    @staticmethod
+    def _splice_markers(prefixes: List[str], translated_cores: List[str], suffixes: List[str]) -> List[str]:
+        return [prefix + core + suffix for prefix, core, suffix in zip(prefixes, translated_cores, suffixes)]
+    
+    async def _request_translations(self, texts: List[str], source_lang: str, target_lang: str,
+                                    reask_missing: bool = True) -> List[Optional[str]]:
+        """Send texts to the model; None marks ids it still skipped after one re-ask"""
+        from langchain_core.messages import HumanMessage, SystemMessage
         
-        system_prompt = self._create_batch_system_prompt(source_lang, target_lang, len(texts))
-        human_prompt = f"Translate the following subtitle texts:\n\n{json.dumps(input_data, ensure_ascii=False, indent=2)}"
+        system_prompt, human_prompt = self._build_batch_prompts(texts, source_lang, target_lang)
         
         messages = [
             SystemMessage(content=system_prompt),
             HumanMessage(content=human_prompt)
         ]
         
+        from openai import APITimeoutError
+        
         try:
-            response = self.llm.invoke(messages)
-            response_text = response.content.strip()
+            response_text, from_cache = await self._cached_invoke(messages)
             
-            # Parse the JSON response
-            try:
-                translated_data = json.loads(response_text)
-                
-                # Extract translated texts in the correct order
-                translated_texts = [None] * len(texts)
-                for item in translated_data:
-                    if isinstance(item, dict) and 'id' in item and 'text' in item:
-                        idx = item['id']
-                        if 0 <= idx < len(texts):
-                            translated_texts[idx] = item['text']
-                
-                # Fill any missing translations with originals
-                for i in range(len(texts)):
-                    if translated_texts[i] is None:
-                        translated_texts[i] = texts[i]
-                
-                return translated_texts
-                
-            except json.JSONDecodeError:
-                # Fallback: try to extract translations line by line if JSON fails
-                print(f"Warning: JSON parsing failed, attempting fallback parsing")
-                return self._fallback_parse_response(response_text, texts)
-                
-        except Exception as e:
-            print(f"Warning: Batch translation failed, using originals: {e}")
-            return texts  # fallback to originals
+        except (APITimeoutError, asyncio.TimeoutError):
+            # Too much for one request: shrink future batches and retry this one in halves
+            self._record_batch_outcome(False)
+            if len(texts) == 1:
+                raise
+            return await self._request_halves(texts, source_lang, target_lang, reask_missing)
+        
+        translations = self._parse_response(response_text, len(texts))
+        
+        # A reply that skipped ids or outgrew the reply budget the batch was packed against
+        # (eating into context_buffer, close to max_tokens) means the batch was too big
+        missing = [i for i, translated_text in enumerate(translations) if translated_text is None]
+        response_tokens = len(self._enc.encode(response_text))
+        self._record_batch_outcome(not missing and response_tokens <= self._reply_budget())
+        
+        # Replies that skipped ids or were cut off are not stored, or every re-run would replay them
+        if not missing and not from_cache:
+            self._store_reply(messages, response_text)
+        
+        # Ask again for just the skipped ids rather than repeating the whole batch
+        if missing and reask_missing:
+            retried = await self._request_translations(
+                [texts[i] for i in missing], source_lang, target_lang, reask_missing=False
+            )
+            for i, translated_text in zip(missing, retried):
+                translations[i] = translated_text
+        
+        return translations
+    
+    async def _request_halves(self, texts: List[str], source_lang: str, target_lang: str,
+                              reask_missing: bool) -> List[Optional[str]]:
+        """Translate the two halves of texts as separate requests"""
+        # One after the other, inside the concurrency slot the batch already holds, so timeouts
+        # never push the number of requests in flight past max_concurrency
+        middle = len(texts) // 2
+        first = await self._request_translations(texts[:middle], source_lang, target_lang, reask_missing)
+        second = await self._request_translations(texts[middle:], source_lang, target_lang, reask_missing)
+        return first + second
+    
+    def _record_batch_outcome(self, ok: bool):
+        """Feed a request's outcome to the adaptive batch sizer, if one is active"""
+        if self.batch_sizer is None:
+            return
+        if ok:
+            self.batch_sizer.on_success()
+        else:
+            self.batch_sizer.on_failure()
+    
+    def _cache_key(self, text: str, source_lang: str, target_lang: str) -> str:
+        return TranslationCache.make_key(self.config.openai.model, PROMPT_VERSION, self.config.openai.protocol,
+                                         source_lang, target_lang, text)
     
-    def _fallback_parse_response(self, response_text: str, original_texts: List[str]) -> List[str]:
+    @staticmethod
+    def _response_format_kwargs(protocol: str) -> dict:
+        """Extra request parameters for the configured wire protocol"""
+        if protocol == "json":
+            from .schemas import BATCH_RESPONSE_FORMAT
+            return {"response_format": BATCH_RESPONSE_FORMAT}
+        return {}
+    
+    def _build_batch_prompts(self, texts: List[str], source_lang: str, target_lang: str):
+        """Build the (system, human) prompt pair for one batch"""
+        protocol = self.config.openai.protocol
+        system_prompt = self._create_batch_system_prompt(source_lang, target_lang, protocol)
+        
+        if protocol == "json":
+            # Create input JSON structure
+            input_data = []
+            for i, text in enumerate(texts):
+                input_data.append({"id": i, "text": text})
+            payload = orjson.dumps(input_data).decode('utf-8')
+        else:
+            # One 'id<TAB>text' line per entry, with line breaks inside a subtitle escaped
+            payload = "\n".join(f"{i}\t{self._escape_delimited(text)}" for i, text in enumerate(texts))
+        
+        human_prompt = f"Translate the following {len(texts)} subtitle texts:\n\n{payload}"
+        return system_prompt, human_prompt
+    
+    @staticmethod
+    def _escape_delimited(text: str) -> str:
+        # Backslashes first, so a literal '\n' in the source (C:\new) can't come back as a line break
+        return text.replace('\\', '\\\\').replace('\t', ' ').replace('\n', '\\n')
+    
+    @staticmethod
+    def _unescape_delimited(text: str) -> str:
+        return DELIMITED_ESCAPE_PATTERN.sub(lambda m: '\n' if m.group(1) == 'n' else '\\', text)
+    
+    def _parse_response(self, response_text: str, num_texts: int) -> List[Optional[str]]:
+        """Extract translated texts by id; None marks ids the model skipped"""
+        if self.config.openai.protocol == "json":
+            return self._parse_structured_response(response_text, num_texts)
+        return self._parse_delimited_response(response_text, num_texts)
+    
+    def _parse_delimited_response(self, response_text: str, num_texts: int) -> List[Optional[str]]:
+        """Extract translated texts from 'id<TAB>translation' lines"""
+        translated_texts = [None] * num_texts
+        for line in response_text.splitlines():
+            if "\t" not in line:
+                continue
+            
+            idx, text = line.split("\t", 1)
+            idx = idx.strip()
+            if idx.isdigit() and int(idx) < num_texts:
+                translated_texts[int(idx)] = self._unescape_delimited(text.strip())
+        
+        return translated_texts
+    
+    def _parse_structured_response(self, response_text: str, num_texts: int) -> List[Optional[str]]:
+        """Extract translated texts by id from a structured response; None marks ids the model skipped"""
+        from .schemas import BatchOut
+        
+        try:
+            result = BatchOut.model_validate_json(response_text)
+        except ValueError:
+            # Structured output only fails to validate when the reply was cut off
+            print("Warning: Structured response incomplete, salvaging complete entries")
+            return self._fallback_parse_response(response_text, num_texts)
+        
+        # Extract translated texts in the correct order
+        translated_texts = [None] * num_texts
+        for item in result.translations:
+            if 0 <= item.id < num_texts:
+                translated_texts[item.id] = item.text
+        
+        return translated_texts
+    
+    def _fallback_parse_response(self, response_text: str, num_texts: int) -> List[Optional[str]]:
         """
-        Fallback parser if JSON format fails
+        Recover every complete {"id", "text"} pair from a truncated JSON reply in one regex pass
         """
-        lines = response_text.strip().split('\n')
-        translations = []
-        
-        # Try to extract meaningful content
-        for line in lines:
-            line = line.strip()
-            if line and not line.startswith('{') and not line.startswith('[') and not line.startswith('"id"'):
-                # Remove common JSON artifacts
-                line = line.replace('"text":', '').replace('"', '').strip()
-                if line.startswith(': '):
-                    line = line[2:]
-                if line and line != ',':
-                    translations.append(line)
-        
-        # Ensure we have the right number of translations
-        while len(translations) < len(original_texts):
-            translations.append(original_texts[len(translations)])
-            
-        return translations[:len(original_texts)]
+        translated_texts = [None] * num_texts
+        for match in ENTRY_PATTERN.finditer(response_text):
+            idx = int(match.group(1))
+            if idx < num_texts:
+                # The captured value is still JSON-escaped; let the JSON parser unescape it
+                translated_texts[idx] = orjson.loads(f'"{match.group(2)}"')
+        
+        return translated_texts
     
-    def _create_batch_system_prompt(self, source_lang: str, target_lang: str, num_texts: int) -> str:
+    async def _cached_invoke(self, messages) -> Tuple[str, bool]:
+        """
+        Return the reply text and whether it came from the response cache, reusing the stored
+        reply when the exact same request was sent before
+        """
+        if self.response_cache is not None:
+            response_text = self.response_cache.get(self._response_cache_key(messages))
+            if response_text is not None:
+                return response_text, True
+        return (await self._invoke(messages)).content, False
+    
+    def _store_reply(self, messages, response_text: str):
+        """Keep a reply for identical future requests; only call this once it parsed completely"""
+        if self.response_cache is not None:
+            self.response_cache.set(self._response_cache_key(messages), response_text, expire=self.config.cache.ttl)
+    
+    def _response_cache_key(self, messages) -> str:
+        digest = hashlib.blake2b()
+        for part in (self.config.openai.model, str(self.config.openai.temperature), self.config.openai.protocol):
+            digest.update(part.encode('utf-8') + b'\0')
+        for message in messages:
+            digest.update(f"{message.type}:{message.content}".encode('utf-8') + b'\0')
+        return digest.hexdigest()
+    
+    async def _invoke(self, messages):
+        """Call the model once the rate limiter has room, backing off on 429s and dropped connections"""
+        from openai import APIConnectionError, APITimeoutError, RateLimitError
+        from tenacity import (AsyncRetrying, retry_if_exception_type, retry_if_not_exception_type,
+                              stop_after_attempt, wait_random_exponential)
+        
+        # Like the cookbook, count the completion budget too since OpenAI reserves max_tokens
+        tokens = sum(len(self._enc.encode(message.content)) for message in messages)
+        tokens += self.config.openai.max_tokens
+        
+        async for attempt in AsyncRetrying(
+            # Timeouts are connection errors too, but they are split into smaller requests instead
+            retry=(retry_if_exception_type((RateLimitError, APIConnectionError))
+                   & retry_if_not_exception_type(APITimeoutError)),
+            wait=wait_random_exponential(min=1, max=60),
+            stop=stop_after_attempt(6),
+            reraise=True
+        ):
+            with attempt:
+                await self.rate_limiter.acquire(tokens=tokens)
+                return await self.retrying_llm.ainvoke(messages)
+    
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _create_batch_system_prompt(source_lang: str, target_lang: str, protocol: str) -> str:
+        # Depends only on the language pair and protocol, so it is built once per run. At a few
+        # hundred tokens it is below the 1024-token prefix OpenAI's prompt caching needs, and
+        # padding it up to that would cost more than the cache discount saves
+        if protocol == "delimited":
+            return f"""You are a professional subtitle translator. Translate subtitles from {source_lang} to {target_lang}.
+
+You will receive one subtitle entry per line, written as an id, a TAB character, then the text.
+
+CRITICAL RULES:
+1. Reply with one line per entry: the same id, a TAB character, then the translation
+2. Translate ONLY the text after the TAB
+3. Keep translations concise and appropriate for subtitles
+4. Copy any tags or bracketed notes inside the text unchanged
+5. Line breaks inside a subtitle are written as \\n and backslashes as \\\\; keep both as written
+6. Return exactly as many lines as received, with the same ids, and nothing else
+
+Example format:
+Input:
+0\tHello world
+1\tHow are you?\\nFine, thanks.
+Output:
+0\tHola mundo
+1\t¿Cómo estás?\\nBien, gracias."""
+        
         return f"""You are a professional subtitle translator. Translate subtitles from {source_lang} to {target_lang}.
 
-You will receive a JSON array with {num_texts} subtitle entries, each with an "id" and "text" field.
+You will receive a JSON array of subtitle entries, each with an "id" and "text" field.
 
 CRITICAL RULES:
-1. Return a JSON array with the same structure, keeping the same "id" for each entry
+1. Return every entry in "translations", keeping the same "id" for each entry
 2. Translate ONLY the "text" field for each entry
 3. Keep translations concise and appropriate for subtitles  
-4. Preserve speaker indicators like [SPEAKER], (sound effects), etc.
+4. Copy any tags or bracketed notes inside the text unchanged
 5. Maintain line breaks within the subtitle text
-6. Do NOT add explanations or extra text outside the JSON
-7. Ensure you return exactly {num_texts} entries with the same IDs
+6. Return exactly as many entries as received, with the same IDs
 
 Example format:
 Input: [{{"id": 0, "text": "Hello world"}}, {{"id": 1, "text": "How are you?"}}]
-Output: [{{"id": 0, "text": "Hola mundo"}}, {{"id": 1, "text": "¿Cómo estás?"}}]
-
-Your response must be valid JSON only."""
+Output: {{"translations": [{{"id": 0, "text": "Hola mundo"}}, {{"id": 1, "text": "¿Cómo estás?"}}]}}"""
     
-    def _load_checkpoint(self, checkpoint_file: str, original_entries: List[SubtitleEntry]) -> List[SubtitleEntry]:
-        """Load existing translations from checkpoint file"""
+    def _load_checkpoint(self, checkpoint_file: str, original_entries: SubtitleTable) -> SubtitleTable:
+        """Load existing translations from the JSONL checkpoint file"""
+        translated = SubtitleTable()
         if not os.path.exists(checkpoint_file):
-            return []
+            return translated
         
         try:
-            with open(checkpoint_file, 'r', encoding='utf-8') as f:
-                checkpoint_data = json.load(f)
-            
-            translated_entries = []
-            for entry_data in checkpoint_data:
-                translated_entries.append(SubtitleEntry(
-                    index=entry_data['index'],
-                    start_time=entry_data['start_time'],
-                    end_time=entry_data['end_time'],
-                    text=entry_data['text']
-                ))
-            
-            return translated_entries
+            with open(checkpoint_file, 'rb') as f:
+                for line in f:
+                    entry_data = orjson.loads(line)
+                    translated.append(
+                        entry_data['index'],
+                        entry_data['start_time'],
+                        entry_data['end_time'],
+                        entry_data['text']
+                    )
             
         except Exception as e:
-            print(f"Warning: Could not load checkpoint file: {e}")
-            return []
+            # A run killed mid-write leaves a partial last line; keep everything before it
+            print(f"Warning: Could not load whole checkpoint file, resuming after "
+                  f"{len(translated)} entries: {e}")
+        
+        return translated
     
-    def _save_checkpoint(self, checkpoint_file: str, translated_entries: List[SubtitleEntry]):
-        """Save current progress to checkpoint file"""
+    def _save_checkpoint(self, checkpoint_file: str, translated: SubtitleTable):
+        """Rewrite the checkpoint file with the given entries"""
         try:
-            checkpoint_data = []
-            for entry in translated_entries:
-                checkpoint_data.append({
-                    'index': entry.index,
-                    'start_time': entry.start_time,
-                    'end_time': entry.end_time,
-                    'text': entry.text
-                })
-            
-            with open(checkpoint_file, 'w', encoding='utf-8') as f:
-                json.dump(checkpoint_data, f, ensure_ascii=False, indent=2)
+            with open(checkpoint_file, 'wb') as f:
+                self._append_checkpoint(f, translated)
                 
         except Exception as e:
-            print(f"Warning: Could not save checkpoint: {e}")
\ No newline at end of file
+            print(f"Warning: Could not save checkpoint: {e}")
+    
+    def _append_checkpoint(self, checkpoint, translated: SubtitleTable):
+        """Write one JSON line per entry to a checkpoint file open in binary mode"""
+        checkpoint.write(b''.join(
+            orjson.dumps({
+                'index': index,
+                'start_time': start,
+                'end_time': end,
+                'text': text
+            }, option=orjson.OPT_APPEND_NEWLINE)
+            for index, start, end, text in zip(translated.index, translated.start, translated.end, translated.text)
+        ))
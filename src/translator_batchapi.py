@@ -0,0 +1,206 @@
+import io
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+import orjson
+from openai import OpenAI
+
+from .srt_parser import SubtitleTable
+from .translator import SubtitleTranslator
+
+
+# Batch statuses after which OpenAI will not make further progress
+FINISHED_STATUSES = {"completed", "expired"}
+FAILED_STATUSES = {"failed", "cancelling", "cancelled"}
+
+
+class BatchAPITranslator:
+    """
+    Translate a whole file through the OpenAI Batch API: half the price of the
+    synchronous endpoint and no RPM ceiling, at the cost of up to 24h turnaround
+    """
+
+    def __init__(self, translator: SubtitleTranslator, api_key: str, poll_interval: int = 30):
+        self.translator = translator
+        self.config = translator.config
+        self.parser = translator.parser
+        self.client = OpenAI(api_key=api_key)
+        self.poll_interval = poll_interval
+
+    def translate_file(self, input_file: str, output_file: str, source_lang: str, target_lang: str,
+                      batch_size: Optional[int] = None, verbose: bool = False):
+        """
+        Submit every batch as one Batch API job, wait for it and map the results back
+        """
+        entries = self.parser.parse(input_file)
+        if verbose:
+            print(f"Loaded {len(entries)} subtitle entries from {input_file}")
+
+        # A known batch id means a previous run already submitted the job, so only poll.
+        # Kept apart from sync mode's .checkpoint so neither mode can clobber the other's progress
+        job_file = f"{output_file}.batchjob"
+        batch_id, batches = self._load_batch_job(job_file)
+
+        if batch_id:
+            if verbose:
+                print(f"Resuming batch job {batch_id} from {job_file}")
+        else:
+            batches = self.translator.pack_batches(entries, max_entries=batch_size)
+            batch_id = self.submit_batch_job(entries, batches, source_lang, target_lang)
+            self._save_batch_job(job_file, batch_id, batches)
+            if verbose:
+                print(f"Submitted batch job {batch_id} with {len(batches)} requests "
+                      f"(avg {len(entries) / max(len(batches), 1):.1f} entries/request)")
+
+        batch = self._wait_for_batch(batch_id, verbose)
+        if batch.status in FAILED_STATUSES:
+            # Drop the job file so the next run submits a fresh job
+            os.remove(job_file)
+            raise RuntimeError(f"Batch job {batch_id} ended with status '{batch.status}'")
+
+        results = self._download_results(batch)
+
+        translated_texts = [None] * len(entries)
+        for i, batch_end in batches:
+            prefixes, texts, suffixes = self.translator._split_markers(entries.text[i:batch_end])
+            batch_translations = self._parse_result(results.get(f"b{i}"), i, texts)
+
+            for j, (prefix, text, suffix, translated_text) in enumerate(
+                    zip(prefixes, texts, suffixes, batch_translations)):
+                # Marker-only lines were sent empty; keep them empty whatever the model replied
+                if not text:
+                    translated_text = text
+                if translated_text is not None:
+                    translated_texts[i + j] = prefix + translated_text + suffix
+
+        # Whatever the job did not deliver (failed or expired requests, unparseable replies,
+        # skipped ids) goes through the synchronous endpoint rather than keeping the originals.
+        # If that fails too the job file stays, so a re-run retries just these entries
+        missing = [k for k, translated_text in enumerate(translated_texts) if translated_text is None]
+        if missing:
+            print(f"Warning: Batch job left {len(missing)} entries untranslated, translating them directly")
+            missing_entries = SubtitleTable()
+            for k in missing:
+                missing_entries.append(entries.index[k], entries.start[k], entries.end[k], entries.text[k])
+
+            retried = self.translator.translate_entries(missing_entries, source_lang, target_lang)
+            for k, translated_text in zip(missing, retried.text):
+                translated_texts[k] = translated_text
+
+        translated = entries.slice(0, len(entries), text=translated_texts)
+        self.parser.write_srt(translated, output_file)
+
+        # Clean up job file on successful completion
+        if os.path.exists(job_file):
+            os.remove(job_file)
+            if verbose:
+                print("Translation completed successfully, batch job file removed")
+
+        return translated
+
+    def submit_batch_job(self, entries: SubtitleTable, batches: List[Tuple[int, int]],
+                         source_lang: str, target_lang: str) -> str:
+        """Upload all batches as a JSONL request file and start a batch job, returning its id"""
+        lines = []
+        for i, batch_end in batches:
+            # Only the text between leading and trailing markers is translated, as in sync mode
+            _, texts, _ = self.translator._split_markers(entries.text[i:batch_end])
+            system_prompt, human_prompt = self.translator._build_batch_prompts(texts, source_lang, target_lang)
+
+            lines.append(orjson.dumps({
+                "custom_id": f"b{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.config.openai.model,
+                    "temperature": self.config.openai.temperature,
+                    "max_tokens": self.config.openai.max_tokens,
+                    "messages": [
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": human_prompt}
+                    ],
+                    **self.translator._response_format_kwargs(self.config.openai.protocol)
+                }
+            }, option=orjson.OPT_APPEND_NEWLINE))
+
+        payload = io.BytesIO(b''.join(lines))
+        input_file = self.client.files.create(file=("subtitles.jsonl", payload), purpose="batch")
+
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch.id
+
+    def _wait_for_batch(self, batch_id: str, verbose: bool):
+        """Poll the batch job until OpenAI stops working on it"""
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in FINISHED_STATUSES or batch.status in FAILED_STATUSES:
+                return batch
+
+            if verbose:
+                counts = batch.request_counts
+                done = f" ({counts.completed}/{counts.total} requests done)" if counts else ""
+                print(f"Batch job {batch_id} is {batch.status}{done}, checking again in {self.poll_interval}s")
+            time.sleep(self.poll_interval)
+
+    def _parse_result(self, response_text: Optional[str], i: int, texts: List[str]) -> List[Optional[str]]:
+        """Translations for the batch starting at entry i; None marks entries the job did not deliver"""
+        if response_text is None:
+            print(f"Warning: No result for entries {i+1}-{i+len(texts)}")
+            return [None] * len(texts)
+
+        try:
+            return self.translator._parse_response(response_text, len(texts))
+        except ValueError as e:
+            print(f"Warning: Could not parse result for entries {i+1}-{i+len(texts)}: {e}")
+            return [None] * len(texts)
+
+    def _download_results(self, batch) -> Dict[str, str]:
+        """Stream the output file and return response content keyed by custom_id"""
+        results = {}
+        if not batch.output_file_id:
+            return results
+
+        content = self.client.files.content(batch.output_file_id)
+        for line in content.iter_lines():
+            if not line.strip():
+                continue
+
+            record = orjson.loads(line)
+            response = record.get('response') or {}
+            if response.get('status_code') != 200:
+                continue
+
+            results[record['custom_id']] = response['body']['choices'][0]['message']['content']
+
+        return results
+
+    def _load_batch_job(self, job_file: str) -> Tuple[Optional[str], List[Tuple[int, int]]]:
+        """Return the batch id and entry ranges saved by an earlier run, if any"""
+        if not os.path.exists(job_file):
+            return None, []
+
+        try:
+            with open(job_file, 'rb') as f:
+                job_data = orjson.loads(f.read())
+
+            if isinstance(job_data, dict) and job_data.get('batch_id'):
+                batches = [(start, end) for start, end in job_data['batches']]
+                return job_data['batch_id'], batches
+            return None, []
+
+        except Exception as e:
+            print(f"Warning: Could not load batch job file: {e}")
+            return None, []
+
+    def _save_batch_job(self, job_file: str, batch_id: str, batches: List[Tuple[int, int]]):
+        """Remember the submitted batch so a restart polls instead of resubmitting"""
+        try:
+            with open(job_file, 'wb') as f:
+                f.write(orjson.dumps({'batch_id': batch_id, 'batches': batches}))
+
+        except Exception as e:
+            print(f"Warning: Could not save batch job file: {e}")
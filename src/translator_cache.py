@@ -0,0 +1,45 @@
+import hashlib
+import sqlite3
+from typing import Dict, List
+
+
+# Stay well below SQLite's limit on bound parameters per statement
+MAX_KEYS_PER_QUERY = 500
+
+
+class TranslationCache:
+    """
+    Persistent content-addressed store of translated subtitle texts, so duplicate
+    lines and re-runs on similar files don't pay for the same translation twice
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model: str, prompt_version: int, protocol: str, source_lang: str, target_lang: str,
+                 text: str) -> str:
+        """Hash everything that influences the translation of a text"""
+        raw = f"{model}|{prompt_version}|{protocol}|{source_lang}|{target_lang}|{text}"
+        return hashlib.blake2b(raw.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Return the cached translations for the given keys, skipping misses"""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for i in range(0, len(unique_keys), MAX_KEYS_PER_QUERY):
+            chunk = unique_keys[i:i + MAX_KEYS_PER_QUERY]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(f"SELECT key, value FROM cache WHERE key IN ({placeholders})", chunk)
+            found.update(rows)
+        return found
+
+    def set_many(self, items: Dict[str, str]):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", items.items())
+
+    def close(self):
+        self.conn.close()